@@ -0,0 +1,20 @@
+# clients.py
+
+import logging
+from functools import lru_cache
+from google import genai
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=8)
+def get_genai_client(api_key):
+    # One client (and HTTP connection pool) per api_key for the whole process,
+    # shared by query embedding and Gemini context caching
+    try:
+        client = genai.Client(api_key=api_key, http_options=types.HttpOptions(api_version='v1alpha'))
+        logger.info("Google Gemini client initialized.")
+        return client
+    except Exception as e:
+        logger.error(f"Failed to initialize Gemini client: {str(e)}")
+        raise
@@ -0,0 +1,89 @@
+# doc_store.py
+
+import json
+import os
+import pickle
+import sys
+from collections.abc import Sequence
+import numpy as np
+
+FIELDS_FILE = "fields.json"
+
+
+def write_doc_store(docs, path):
+    """
+    Write a list of document dicts as a columnar store: for every field, one UTF-8
+    blob (`<field>.data.npy`), row offsets into it (`<field>.offsets.npy`) and a
+    presence mask (`<field>.present.npy`).
+    """
+    os.makedirs(path, exist_ok=True)
+    fields = []
+    for doc in docs:
+        for field in doc:
+            if field not in fields:
+                fields.append(field)
+
+    for field in fields:
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        present = np.zeros(len(docs), dtype=bool)
+        chunks = []
+        for i, doc in enumerate(docs):
+            encoded = b""
+            if field in doc:
+                present[i] = True
+                encoded = str(doc[field]).encode("utf-8")
+            chunks.append(encoded)
+            offsets[i + 1] = offsets[i] + len(encoded)
+        data = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+        np.save(os.path.join(path, f"{field}.data.npy"), data)
+        np.save(os.path.join(path, f"{field}.offsets.npy"), offsets)
+        np.save(os.path.join(path, f"{field}.present.npy"), present)
+
+    with open(os.path.join(path, FIELDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(fields, f)
+
+
+class DocStore(Sequence):
+    """
+    Read-only view over a store written by write_doc_store. Columns are memory-mapped,
+    so loading is O(header) and worker processes share the pages; a row is only
+    decoded into a dict when it is indexed.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, FIELDS_FILE), encoding="utf-8") as f:
+            self.fields = json.load(f)
+        self._columns = {
+            field: tuple(
+                np.load(os.path.join(path, f"{field}.{part}.npy"), mmap_mode="r")
+                for part in ("data", "offsets", "present")
+            )
+            for field in self.fields
+        }
+        first = self.fields[0] if self.fields else None
+        self._length = len(self._columns[first][2]) if first else 0
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError(f"DocStore index {i} out of range")
+        doc = {}
+        for field, (data, offsets, present) in self._columns.items():
+            if present[i]:
+                doc[field] = data[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+        return doc
+
+
+if __name__ == "__main__":
+    # Convert a pickled metadata list: python -m app.doc_store doc_metadata.pkl doc_metadata
+    src, dst = sys.argv[1], sys.argv[2]
+    with open(src, "rb") as f:
+        docs = pickle.load(f)
+    write_doc_store(docs, dst)
+    print(f"Wrote {len(docs)} entries from {src} to {dst}")
@@ -1,33 +1,147 @@
+import asyncio
 import requests
 import json
+import logging
+import orjson
+import re
+import threading
+import time
+from cachetools import TTLCache
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.genai import types
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+from app.clients import get_genai_client
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = "http://localhost:11434/api/generate"
+# (connect, read) timeouts; local generation can take a while on CPU
+OLLAMA_TIMEOUT = (3.05, 120)
+
+# Shared session so keep-alive connections are pooled across chatbot turns
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+_ADAPTER = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+# Gemini explicit context caching: the system prompt is uploaded once per (api_key, model)
+# and referenced by name, instead of being re-sent with every request.
+CONTEXT_CACHE_TTL = 3600  # seconds
+CONTEXT_CACHE_REFRESH_MARGIN = 300  # extend the TTL when less than this is left
+# (api_key, model, system_prompt) -> (cache name or None, expires_at). Bounded, and entries
+# expire along with the server-side caches they name.
+_CONTEXT_CACHES = TTLCache(maxsize=64, ttl=CONTEXT_CACHE_TTL)
+# Held across create/refresh so concurrent first requests don't each create (and pay for) a cache
+_CONTEXT_CACHES_LOCK = threading.Lock()
+
+def _supports_context_cache(model: str) -> bool:
+    # Explicit caching is only available from gemini-1.5 onwards
+    match = re.match(r"(?:models/)?gemini-(\d+)\.(\d+)", model)
+    return bool(match) and (int(match.group(1)), int(match.group(2))) >= (1, 5)
+
+def get_context_cache(api_key: str, model: str, system_prompt: str):
+    """
+    Return the name of a Gemini cachedContents entry holding system_prompt, creating or
+    refreshing it as needed. Returns None when the model or request does not support
+    caching, in which case callers should send the system prompt inline.
+    """
+    if not system_prompt or not _supports_context_cache(model):
+        return None
+
+    key = (api_key, model, system_prompt)
+    with _CONTEXT_CACHES_LOCK:
+        name, expires_at = _CONTEXT_CACHES.get(key, (None, 0))
+        now = time.time()
+        if expires_at - now > CONTEXT_CACHE_REFRESH_MARGIN:
+            return name
+
+        # Same per-key client the retriever embeds with
+        client = get_genai_client(api_key)
+        try:
+            if name:
+                client.caches.update(
+                    name=name,
+                    config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL}s"),
+                )
+                logger.info(f"Refreshed Gemini context cache {name}")
+            else:
+                cached = client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        ttl=f"{CONTEXT_CACHE_TTL}s",
+                    ),
+                )
+                name = cached.name
+                logger.info(f"Created Gemini context cache {name} for model {model}")
+        except Exception as e:
+            # e.g. the prompt is below the model's minimum cacheable size; don't retry until the TTL passes
+            logger.warning(f"Gemini context caching unavailable for model {model}, using inline system prompt: {e}")
+            name = None
+
+        _CONTEXT_CACHES[key] = (name, now + CONTEXT_CACHE_TTL)
+        return name
+
+@lru_cache(maxsize=32)
+def _get_llm(api_key: str, model: str, cached_content: str = None):
+    # Constructing the client sets up credentials and the gRPC channel, so reuse it per key/model
+    return ChatGoogleGenerativeAI(
+        model=model,
+        temperature=0.2,
+        max_output_tokens=1024,
+        api_key=api_key,
+        cached_content=cached_content,
+    )
+
+def _build_messages(prompt: str, system_prompt: str = None):
+    # Format messages with 'role' and 'content' keys
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+# Finish reasons for a candidate that was cut off by a content filter
+BLOCKED_FINISH_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"}
+
+def check_gemini_response(response):
+    # Check for block reason in the response. Streamed chunks only carry prompt_feedback
+    # when the prompt was blocked, so a missing entry means it was not.
+    block_reason = response.response_metadata.get("prompt_feedback", {}).get("block_reason", 0)
+    if block_reason != 0:
+        raise ValueError(f"Request blocked: {block_reason}")
+    finish_reason = response.response_metadata.get("finish_reason")
+    if finish_reason in BLOCKED_FINISH_REASONS:
+        raise ValueError(f"Response blocked: {finish_reason}")
+    safety_ratings = response.response_metadata.get("safety_ratings", [])
+    if any(rating.get("blocked") for rating in safety_ratings):
+        raise ValueError(f"Request blocked by safety ratings: {safety_ratings}")
+    if not response.content:
+        raise ValueError("Empty response content")
+    return response
+
+async def _aprepare_gemini(api_key: str, prompt: str, model: str, system_prompt: str, use_context_cache: bool):
+    cached_content = None
+    if use_context_cache:
+        cached_content = await asyncio.to_thread(get_context_cache, api_key, model, system_prompt)
+    llm = _get_llm(api_key, model, cached_content)
+    # The cached content already carries the system instruction
+    messages = _build_messages(prompt, None if cached_content else system_prompt)
+    return llm, messages
+
 def call_gemini(api_key: str, prompt: str, model: str = "gemini-1.5-flash-latest", system_prompt: str = None):
     try:
-        llm = ChatGoogleGenerativeAI(
-            model=model,
-            temperature=0.2,
-            max_output_tokens=1024,
-            api_key=api_key,
-        )
-        # Format messages with 'role' and 'content' keys
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-
-        response = llm.invoke(messages)
-
-        # Check for block reason in the response
-        if response.response_metadata.get("prompt_feedback", {}).get("block_reason") != 0:
-            raise ValueError(f"Request blocked: {response.response_metadata['prompt_feedback']['block_reason']}")
-        safety_ratings = response.response_metadata.get("safety_ratings", [])
-        if any(rating.get("blocked") for rating in safety_ratings):
-            raise ValueError(f"Request blocked by safety ratings: {safety_ratings}")
-        if not response.content:
-            raise ValueError("Empty response content")
-
-        return response
+        llm = _get_llm(api_key, model)
+        response = llm.invoke(_build_messages(prompt, system_prompt))
+        return check_gemini_response(response)
         
     except requests.exceptions.RequestException as e:
         raise requests.exceptions.RequestException(f"API request failed: {str(e)}")
@@ -35,6 +149,27 @@ def call_gemini(api_key: str, prompt: str, model: str = "gemini-1.5-flash-latest
         raise KeyError(f"Unexpected response format: {str(e)}")
     except IndexError as e:
         raise IndexError(f"Unexpected response format: {str(e)}")
+
+async def acall_gemini(api_key: str, prompt: str, model: str = "gemini-1.5-flash-latest", system_prompt: str = None,
+                       use_context_cache: bool = False):
+    # Same as call_gemini, but awaits the model so the event loop is free while Gemini generates
+    try:
+        llm, messages = await _aprepare_gemini(api_key, prompt, model, system_prompt, use_context_cache)
+        response = await llm.ainvoke(messages)
+        return check_gemini_response(response)
+
+    except KeyError as e:
+        raise KeyError(f"Unexpected response format: {str(e)}")
+    except IndexError as e:
+        raise IndexError(f"Unexpected response format: {str(e)}")
+
+async def acall_gemini_stream(api_key: str, prompt: str, model: str = "gemini-1.5-flash-latest", system_prompt: str = None,
+                              use_context_cache: bool = False):
+    # Yields AIMessageChunks as Gemini produces them; callers can add the chunks up to get the full message
+    llm, messages = await _aprepare_gemini(api_key, prompt, model, system_prompt, use_context_cache)
+    async for chunk in llm.astream(messages):
+        yield chunk
+
 def call_ollama(prompt, model="qwen2.5:7b", system_prompt=None):
     payload = {
         "model": model,
@@ -44,6 +179,6 @@ def call_ollama(prompt, model="qwen2.5:7b", system_prompt=None):
     if system_prompt:
         payload["system"] = system_prompt
 
-    response = requests.post("http://localhost:11434/api/generate", json=payload)
+    response = _SESSION.post(OLLAMA_URL, json=payload, timeout=OLLAMA_TIMEOUT)
     response.raise_for_status()
-    return response.json()["response"]
\ No newline at end of file
+    return orjson.loads(response.content)["response"]
\ No newline at end of file
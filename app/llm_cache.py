@@ -0,0 +1,85 @@
+# llm_cache.py
+
+import hashlib
+import json
+import logging
+import faiss
+import numpy as np
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model: str, system_prompt: str, prompt: str) -> str:
+    payload = json.dumps(
+        {"model": model, "system_prompt": system_prompt, "prompt": prompt},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Two-tier cache for LLM responses.
+    - Exact tier: TTL/LRU cache keyed by cache_key(model, system_prompt, prompt).
+    - Semantic tier: inner-product FAISS index over the normalized embeddings of
+      cached queries; a lookup returns the closest of the top `neighbors` matches
+      that is in the same scope, still cached, and at least `similarity_threshold`
+      similar.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, similarity_threshold=0.92, embedding_dim=768, neighbors=8):
+        self.similarity_threshold = similarity_threshold
+        self.neighbors = neighbors
+        self.embedding_dim = embedding_dim
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._index = faiss.IndexFlatIP(embedding_dim)
+        self._index_keys = []
+        self._index_vectors = []
+
+    def get_exact(self, key):
+        return self._entries.get(key)
+
+    def get_semantic(self, embedding, scope=None):
+        if self._index.ntotal == 0:
+            return None
+        query = self._normalize(embedding)
+        # Vectors of expired entries and entries from other scopes stay in the index until
+        # _compact, so look past the nearest one instead of letting it hide a live match
+        D, I = self._index.search(query, min(self.neighbors, self._index.ntotal))
+        for score, row in zip(D[0], I[0]):
+            if row < 0 or score < self.similarity_threshold:
+                break  # results are sorted by decreasing similarity
+            entry_scope, key = self._index_keys[row]
+            if entry_scope != scope:
+                continue
+            value = self._entries.get(key)
+            if value is not None:
+                logger.debug("Semantic cache hit (similarity %.3f)", score)
+                return value
+        return None
+
+    def set(self, key, value, embedding=None, scope=None):
+        self._entries[key] = value
+        if embedding is None:
+            return
+        if len(self._index_keys) >= 2 * self._entries.maxsize:
+            self._compact()
+        vector = self._normalize(embedding)
+        self._index.add(vector)
+        self._index_keys.append((scope, key))
+        self._index_vectors.append(vector)
+
+    def _compact(self):
+        # Drop vectors whose entries have expired or been evicted from the exact tier
+        live = [(k, v) for k, v in zip(self._index_keys, self._index_vectors) if k[1] in self._entries]
+        self._index = faiss.IndexFlatIP(self.embedding_dim)
+        self._index_keys = [k for k, _ in live]
+        self._index_vectors = [v for _, v in live]
+        if self._index_vectors:
+            self._index.add(np.vstack(self._index_vectors))
+
+    def _normalize(self, embedding):
+        vector = np.array(embedding, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
@@ -1,20 +1,61 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import asyncio
+import atexit
+import hashlib
+import orjson
 import os
 import logging
-from pydantic import BaseModel, ConfigDict
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from pydantic import BaseModel, ValidationError
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional, List, Dict, Any
 import re
+import threading
+from contextlib import asynccontextmanager
+from cachetools import LRUCache
+from langchain_core.messages import AIMessage
 from langsmith import Client
 
-from app.retriever import Retriever
-from app.llm import call_gemini
+from app.retriever import Retriever, close_batchers, load_index, load_metadata, set_faiss_threads
+from app.llm import acall_gemini, acall_gemini_stream, check_gemini_response
+from app.llm_cache import LLMCache, cache_key
 
-logging.basicConfig(level=logging.INFO)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL)
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="UALR Chatbot API")
+def setup_queue_logging() -> QueueListener:
+    # Route records through a queue so handlers write to stderr on a background thread,
+    # not on the event loop thread serving requests
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+log_listener = setup_queue_logging()
+# Stopped at interpreter exit rather than app shutdown, so the app can be started again in-process
+atexit.register(log_listener.stop)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await load_retrieval_data()
+    await warm_langsmith_session()
+    await start_feedback_writer()
+    try:
+        yield
+    finally:
+        await close_batchers()
+        await stop_feedback_writer()
+
+app = FastAPI(title="UALR Chatbot API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,7 +68,7 @@ app.add_middleware(
 # Update paths for containerized environment
 BASE_DIR = "/app"
 INDEX_PATH = os.path.join(BASE_DIR, "faiss_index.faiss")
-METADATA_PATH = os.path.join(BASE_DIR, "doc_metadata.pkl")
+METADATA_PATH = os.path.join(BASE_DIR, "doc_metadata")
 
 LANGSMITH_API_KEY = os.environ.get("LANGSMITH_API_KEY")
 if not LANGSMITH_API_KEY:
@@ -35,6 +76,26 @@ if not LANGSMITH_API_KEY:
 LANGSMITH_PROJECT = os.environ.get("LANGSMITH_PROJECT", "ualr-chatbot")
 LANGSMITH_ENDPOINT = os.environ.get("LANGSMITH_ENDPOINT", "https://api.smith.langchain.com")
 
+# Reference the system prompt through Gemini's cachedContents API instead of sending it inline.
+# Gemini only caches prompts above a minimum token count, so this falls back to inline when rejected.
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+
+# Below this top-1 cosine similarity the context is treated as irrelevant and the
+# canned fallback is returned without calling Gemini
+FALLBACK_SCORE_THRESHOLD = float(os.environ.get("FALLBACK_SCORE_THRESHOLD", "0.35"))
+
+# Coalesce concurrent query embeddings into batched embed_content calls. Queries that arrive
+# while an embed call is in flight share the next one, so it is off by default like SEARCH_BATCHING.
+EMBED_BATCHING = os.environ.get("EMBED_BATCHING", "false").lower() == "true"
+# Coalesce concurrent FAISS searches into one index.search call. Only pays off when many
+# searches are in flight at once against a large index, so it is off by default.
+SEARCH_BATCHING = os.environ.get("SEARCH_BATCHING", "false").lower() == "true"
+# Number of uvicorn worker processes sharing this machine's cores
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_SIMILARITY = float(os.environ.get("LLM_CACHE_SIMILARITY", "0.92"))
+
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 FEEDBACK_FILE = os.path.join(APP_DIR, "feedback_log.jsonl")
 
@@ -55,6 +116,10 @@ if LANGSMITH_API_KEY:
     except Exception as e:
         logger.error(f"Failed to initialize LangSmith client: {e}")
 
+llm_cache = LLMCache(ttl=LLM_CACHE_TTL, similarity_threshold=LLM_CACHE_SIMILARITY)
+
+
+_UUID_RE = re.compile(r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})', re.IGNORECASE)
 
 def extract_uuid_from_run_id(run_id: str) -> str:
     """
@@ -65,28 +130,89 @@ def extract_uuid_from_run_id(run_id: str) -> str:
     """
     if not run_id:
         return run_id
+
+    # Already a bare UUID
+    if len(run_id) == 36 and run_id.count('-') == 4:
+        return run_id
     
     # Try to extract UUID pattern from the run_id
-    uuid_pattern = r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})'
-    match = re.search(uuid_pattern, run_id, re.IGNORECASE)
+    match = _UUID_RE.search(run_id)
     
     if match:
         extracted_uuid = match.group(1)
-        logger.info(f"Extracted UUID '{extracted_uuid}' from run_id '{run_id}'")
+        logger.debug("Extracted UUID '%s' from run_id '%s'", extracted_uuid, run_id)
         return extracted_uuid
     
     # If no UUID pattern found, return original (might already be a clean UUID)
     logger.warning(f"Could not extract UUID from run_id: {run_id}")
     return run_id
 
+# Feedback lines are queued by /feedback and appended by a single writer task into a
+# 64 KB buffered file; the buffer is flushed once FEEDBACK_FLUSH_LINES lines or
+# FEEDBACK_FLUSH_INTERVAL seconds have accumulated since the last flush, and on shutdown.
+# The queue holds at most FEEDBACK_QUEUE_SIZE lines (/feedback returns 503 when it is full),
+# and lines from a failed write are kept, up to FEEDBACK_RETRY_LINES, and retried with the
+# next batch or after FEEDBACK_FLUSH_INTERVAL seconds.
+FEEDBACK_FLUSH_LINES = 100
+FEEDBACK_FLUSH_INTERVAL = 5.0
+FEEDBACK_QUEUE_SIZE = 10000
+FEEDBACK_RETRY_LINES = 10000
+FEEDBACK_SHUTDOWN_TIMEOUT = 10.0  # seconds to wait for queued feedback to be written at shutdown
+feedback_queue: Optional[asyncio.Queue] = None
+feedback_writer_task: Optional[asyncio.Task] = None
+
+def write_feedback_lines(f, lines: List[bytes]) -> None:
+    f.write(b"".join(lines))
+
+def retain_failed_lines(lines: List[bytes]) -> List[bytes]:
+    if len(lines) > FEEDBACK_RETRY_LINES:
+        logger.error(f"!!! CRITICAL ERROR: dropping {len(lines) - FEEDBACK_RETRY_LINES} unwritten feedback entries for {FEEDBACK_FILE}")
+    return lines[-FEEDBACK_RETRY_LINES:]
+
+async def feedback_writer(queue: asyncio.Queue, f) -> None:
+    loop = asyncio.get_running_loop()
+    unflushed = 0
+    last_flush = loop.time()
+    pending: List[bytes] = []  # lines whose write failed, retried ahead of new ones
+    try:
+        while True:
+            timeout = FEEDBACK_FLUSH_INTERVAL - (loop.time() - last_flush) if unflushed or pending else None
+            try:
+                lines = [await asyncio.wait_for(queue.get(), timeout)]
+            except asyncio.TimeoutError:
+                lines = []
+            while not queue.empty():
+                lines.append(queue.get_nowait())
+            batch = pending + lines
+            try:
+                if batch:
+                    try:
+                        await asyncio.to_thread(write_feedback_lines, f, batch)
+                    except Exception:
+                        pending = retain_failed_lines(batch)
+                        last_flush = loop.time()  # retry after a full interval unless more feedback arrives
+                        raise
+                    pending = []
+                    unflushed += len(batch)
+                if unflushed and (unflushed >= FEEDBACK_FLUSH_LINES or loop.time() - last_flush >= FEEDBACK_FLUSH_INTERVAL):
+                    await asyncio.to_thread(f.flush)
+                    unflushed = 0
+                    last_flush = loop.time()
+            except Exception as e:
+                logger.error(f"!!! CRITICAL ERROR writing {len(batch)} feedback entries to {FEEDBACK_FILE}: {str(e)}", exc_info=True)
+            finally:
+                for _ in lines:
+                    queue.task_done()
+    finally:
+        try:
+            if pending:
+                write_feedback_lines(f, pending)
+        except Exception as e:
+            logger.error(f"!!! CRITICAL ERROR writing {len(pending)} feedback entries to {FEEDBACK_FILE} at shutdown: {str(e)}")
+        finally:
+            f.close()  # flushes anything still buffered
+
 class FeedbackItem(BaseModel):
-    model_config = ConfigDict(
-        json_encoders={
-            # Tell Pydantic how to encode datetime objects
-            datetime: lambda dt: dt.isoformat()
-        }
-    )
-    
     timestamp: datetime
     query: Optional[str] = None
     response: Optional[str] = None
@@ -115,115 +241,318 @@ add ths to your response if you do not know the answer:
 Contact UALR's main office at (501) 569-3000 or email info@ualr.edu for further assistance."
 """
 
+CANNED_FALLBACK = (
+    "I was unable to find specific information regarding this, but here is what you can do: "
+    "Contact UALR's main office at (501) 569-3000 or email info@ualr.edu for further assistance."
+)
 
-@app.post("/feedback")
-async def store_feedback(feedback: FeedbackItem):
-    # More verbose logging for this specific function
-    request_timestamp_str = feedback.timestamp.isoformat()  # Get a string representation for logging
-    
-    # Print the raw request data for debugging
-    logger.info(f"Received raw feedback data: {feedback}")
-    logger.info(f"feedback_type: {feedback.feedback_type}")
-    
-    # Log specific fields based on feedback type
-    if feedback.feedback_type == "thumbs_up":
-        logger.info(f"thumbs_up_reason: {feedback.thumbs_up_reason}")
-    elif feedback.feedback_type == "thumbs_down":
-        logger.info(f"thumbs_down_reason: {feedback.thumbs_down_reason}")
-    elif feedback.feedback_type == "correction_suggestion":
-        logger.info(f"corrected_question: {feedback.corrected_question}")
-        logger.info(f"correct_answer: {feedback.correct_answer}")
-    
-    logger.info(f"Target feedback file for this request: {FEEDBACK_FILE}")
 
-    if feedback.run_id and langsmith_client:
+async def load_retrieval_data():
+    # Load the FAISS index and metadata before the first request instead of during it
+    set_faiss_threads(WEB_CONCURRENCY)
+    try:
+        await asyncio.to_thread(load_index, INDEX_PATH)
+        await asyncio.to_thread(load_metadata, METADATA_PATH)
+    except Exception as e:
+        # Not fatal: /query retries the load and reports the error per request
+        logger.error(f"Failed to preload retrieval data: {e}")
+
+async def warm_langsmith_session():
+    # Open the LangSmith connection (TLS handshake included) before the first feedback submission
+    if langsmith_client:
         try:
-            # Extract clean UUID from run_id
-            clean_run_id = extract_uuid_from_run_id(feedback.run_id)
-            
-            score = 1.0 if feedback.feedback_type == "thumbs_up" else 0.0
-            comment = feedback.thumbs_up_reason if feedback.feedback_type == "thumbs_up" else feedback.thumbs_down_reason
-            if feedback.feedback_type == "correction_suggestion":
-                comment = f"Correction: Q: {feedback.corrected_question}, A: {feedback.correct_answer}"
-                score = 0.0
-
-            logger.info(f"Submitting feedback to LangSmith with run_id: {clean_run_id}")
-            langsmith_client.create_feedback(
-                run_id=clean_run_id,
-                key="user_rating",
-                score=score,
-                comment=comment or "No comment",
-                # Optional: specify project if needed
-                # project_id=LANGSMITH_PROJECT
-            )
-            logger.info(f"Feedback submitted to LangSmith for run_id {clean_run_id}")
+            await asyncio.to_thread(lambda: langsmith_client.info)
         except Exception as e:
-            logger.error(f"Failed to submit feedback to LangSmith: {e}")
+            logger.warning(f"Failed to warm up LangSmith session: {e}")
+
+def feedback_writer_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"!!! CRITICAL ERROR: feedback writer for {FEEDBACK_FILE} died", exc_info=task.exception())
+
+async def start_feedback_writer():
+    global feedback_queue, feedback_writer_task
+    feedback_queue = asyncio.Queue(maxsize=FEEDBACK_QUEUE_SIZE)
+    feedback_writer_task = None
+    # Open here rather than in the task, so a bad path or permissions fail at startup
+    try:
+        f = await asyncio.to_thread(open, FEEDBACK_FILE, "ab", buffering=1 << 16)
+    except OSError as e:
+        # Not fatal for /query; /feedback returns 500 while the writer is not running
+        logger.error(f"!!! CRITICAL ERROR opening feedback log {FEEDBACK_FILE}: {str(e)}")
+        return
+    feedback_writer_task = asyncio.create_task(feedback_writer(feedback_queue, f))
+    feedback_writer_task.add_done_callback(feedback_writer_done)
+    logger.info(f"Feedback writer started for {FEEDBACK_FILE}")
+
+def feedback_writer_running() -> bool:
+    return feedback_writer_task is not None and not feedback_writer_task.done()
+
+async def stop_feedback_writer():
+    if feedback_writer_task is None:
+        return
+    if feedback_writer_running():
+        # Let queued feedback reach the file before the writer is cancelled
+        try:
+            await asyncio.wait_for(feedback_queue.join(), FEEDBACK_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Timed out writing {feedback_queue.qsize()} queued feedback entries at shutdown")
+    feedback_writer_task.cancel()
+    try:
+        await feedback_writer_task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        pass  # already logged by feedback_writer_done
+    logger.info("Feedback writer stopped")
+
+
+def submit_langsmith_feedback(feedback: FeedbackItem) -> None:
+    try:
+        # Extract clean UUID from run_id
+        clean_run_id = extract_uuid_from_run_id(feedback.run_id)
+        
+        score = 1.0 if feedback.feedback_type == "thumbs_up" else 0.0
+        comment = feedback.thumbs_up_reason if feedback.feedback_type == "thumbs_up" else feedback.thumbs_down_reason
+        if feedback.feedback_type == "correction_suggestion":
+            comment = f"Correction: Q: {feedback.corrected_question}, A: {feedback.correct_answer}"
+            score = 0.0
+
+        langsmith_client.create_feedback(
+            run_id=clean_run_id,
+            key="user_rating",
+            score=score,
+            comment=comment or "No comment",
+            # Optional: specify project if needed
+            # project_id=LANGSMITH_PROJECT
+        )
+        logger.debug("Feedback submitted to LangSmith for run_id %s", clean_run_id)
+    except Exception as e:
+        logger.error(f"Failed to submit feedback to LangSmith: {e}")
+
+async def parse_feedback(request: Request) -> FeedbackItem:
+    # Decode and validate the raw body in a single pydantic-core pass, instead of
+    # json.loads into dicts followed by a second validation pass over them
+    try:
+        return FeedbackItem.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        )
+
+@app.post(
+    "/feedback",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": FeedbackItem.model_json_schema()}},
+            "required": True,
+        }
+    },
+)
+async def store_feedback(background: BackgroundTasks, feedback: FeedbackItem = Depends(parse_feedback)):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received raw feedback data: %r", feedback)
+
+    if feedback.run_id and langsmith_client:
+        # Runs in the threadpool after the response is sent, so a slow LangSmith API doesn't hold the request
+        background.add_task(submit_langsmith_feedback, feedback)
+
+    if not feedback_writer_running():
+        logger.error(f"!!! CRITICAL ERROR storing feedback for timestamp {feedback.timestamp.isoformat()}: feedback writer for {FEEDBACK_FILE} is not running")
+        raise HTTPException(status_code=500, detail="Failed to store feedback: feedback log is unavailable")
 
     try:
-        logger.info(f"[{request_timestamp_str}] Attempting to open file '{FEEDBACK_FILE}' for append...")
-        with open(FEEDBACK_FILE, "a", encoding="utf-8") as f:
-            logger.info(f"[{request_timestamp_str}] File '{FEEDBACK_FILE}' opened successfully in append mode.")
-            
-            # Convert model to JSON string
-            json_data = feedback.model_dump_json()
-            logger.info(f"[{request_timestamp_str}] JSON data to write: {json_data}")
-            
-            line_to_write = json_data + "\n"
-            logger.info(f"[{request_timestamp_str}] Attempting to write line (length {len(line_to_write)})")
-            
-            f.write(line_to_write)
-            logger.info(f"[{request_timestamp_str}] f.write() called. Line should be in file buffer.")
-            
-            f.flush()  # Explicitly flush the OS buffer to disk
-            logger.info(f"[{request_timestamp_str}] f.flush() called. OS buffer flushed to disk.")
-            
-        # The 'with' block automatically closes the file here.
-        logger.info(f"[{request_timestamp_str}] File '{FEEDBACK_FILE}' closed. Write operation complete for this request.")
-        logger.info(f"--- FEEDBACK END for timestamp: {request_timestamp_str} ---")
+        # Serialize straight to bytes with orjson (datetimes are written as isoformat strings)
+        try:
+            line_to_write = orjson.dumps(feedback.model_dump()) + b"\n"
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits in retrieved_docs, which pydantic's encoder handles
+            line_to_write = feedback.model_dump_json().encode("utf-8") + b"\n"
+        feedback_queue.put_nowait(line_to_write)
+
+        logger.debug("Feedback stored: %s", feedback.feedback_type)
         return {"status": "success", "message": "Feedback received"}
+
+    except asyncio.QueueFull:
+        logger.error(f"Feedback queue is full ({FEEDBACK_QUEUE_SIZE} entries); rejecting feedback for timestamp {feedback.timestamp.isoformat()}")
+        raise HTTPException(status_code=503, detail="Feedback log is busy, please retry")
     
     except Exception as e:
         # Log the full traceback for any exception
-        logger.error(f"!!! CRITICAL ERROR storing feedback for timestamp {request_timestamp_str} to {FEEDBACK_FILE}: {str(e)}", exc_info=True)
-        logger.info(f"--- FEEDBACK END (WITH ERROR) for timestamp: {request_timestamp_str} ---")
+        logger.error(f"!!! CRITICAL ERROR storing feedback for timestamp {feedback.timestamp.isoformat()} to {FEEDBACK_FILE}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to store feedback: {str(e)}")
 
+@lru_cache(maxsize=8)
+def get_retriever(api_key: str) -> Retriever:
+    # Built at most once per distinct api_key; the index and metadata are loaded once per process
+    retriever = Retriever(
+        index_path=INDEX_PATH,
+        metadata_path=METADATA_PATH,
+        api_key=api_key,
+        batch_embeddings=EMBED_BATCHING,
+        batch_searches=SEARCH_BATCHING
+    )
+    logger.info("Retriever initialized with index: %s, metadata: %s", INDEX_PATH, METADATA_PATH)
+    return retriever
+
+def query_cache_key(request: QueryRequest):
+    # Responses depend on the retrieved context, so k is part of the cache scope. Entries are
+    # also per api_key: a cached answer is only served to the key whose Gemini quota paid for it.
+    key_id = hashlib.sha256(request.api_key.encode("utf-8")).hexdigest()[:16]
+    scope = (request.model, request.k, key_id)
+    key = cache_key(request.model, SYSTEM_PROMPT, f"key={key_id}\nk={request.k}\n{request.query.strip()}")
+    return key, scope
+
+def replay_cached(cached: Dict[str, Any]) -> Dict[str, Any]:
+    # The stored run_id belongs to the request that produced the answer; feedback on a
+    # replay must not be filed against that LangSmith run
+    return {**cached, "run_id": None}
+
+_CTX_CACHE = LRUCache(maxsize=1024)
+_CTX_CACHE_LOCK = threading.Lock()
+
+def get_context(hits) -> str:
+    # Repeat queries usually retrieve the same documents, so reuse the joined context by row ids
+    doc_ids = tuple(i for i, _, _ in hits)
+    with _CTX_CACHE_LOCK:
+        context = _CTX_CACHE.get(doc_ids)
+    if context is None:
+        # search_hits only returns docs that have a content field
+        context = "\n".join(doc["content"] for _, _, doc in hits)
+        with _CTX_CACHE_LOCK:
+            _CTX_CACHE[doc_ids] = context
+    return context
+
+def build_prompt(query: str, hits) -> str:
+    context = get_context(hits)
+    logger.debug("Retrieved %d documents, context length: %d", len(hits), len(context))
+    # Keep the shared part (context) ahead of the question so identical retrievals
+    # produce a byte-identical prefix for Gemini's implicit prompt caching
+    return f"Context:\n{context}\n\nQuestion: {query}\n\nAnswer concisely:"
+
+# Counts used to tune FALLBACK_SCORE_THRESHOLD, reported by /health
+fallback_stats = {"queries": 0, "fallbacks": 0}
+
+def is_low_confidence(hits) -> bool:
+    fallback_stats["queries"] += 1
+    top_score = max((score for _, score, _ in hits), default=None)
+    if top_score is not None and top_score >= FALLBACK_SCORE_THRESHOLD:
+        return False
+    fallback_stats["fallbacks"] += 1
+    logger.debug(
+        "Low-confidence retrieval (top score: %s), returning canned fallback (%d/%d queries)",
+        top_score, fallback_stats["fallbacks"], fallback_stats["queries"]
+    )
+    return True
+
+def sse_event(event: str, data: Any) -> bytes:
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
 @app.post("/query")
 async def handle_query(request: QueryRequest):
     try:
-        logger.info(f"Received query: {request.query}, k: {request.k}")
-        retriever= Retriever(
-            index_path=INDEX_PATH,
-            metadata_path=METADATA_PATH,
-            api_key=request.api_key
-        )
-        logger.info(f"Retriever initialized with index: {INDEX_PATH}, metadata: {METADATA_PATH}")
-        docs = retriever.query(request.query, k=request.k)
-        context = "\n".join([doc.get("content", "") for doc in docs])
-        logger.info(f"Retrieved {len(docs)} documents, context length: {len(context)}")
+        logger.debug("Received query: %s, k: %d", request.query, request.k)
+        key, scope = query_cache_key(request)
+        cached = llm_cache.get_exact(key)
+        if cached is not None:
+            logger.debug("Exact cache hit, skipping retrieval and LLM call")
+            return replay_cached(cached)
+
+        retriever = get_retriever(request.api_key)
+        embedding = await retriever.aembed(request.query)
+        cached = llm_cache.get_semantic(embedding, scope=scope)
+        if cached is not None:
+            return replay_cached(cached)
 
-        prompt = f"Question: {request.query}\n\nContext:\n{context}\n\nAnswer:"
+        hits = await retriever.asearch_hits(embedding, k=request.k)
+        if is_low_confidence(hits):
+            return {"response": AIMessage(content=CANNED_FALLBACK), "retrieved_docs": [], "run_id": None}
+        docs = [doc for _, _, doc in hits]
+        prompt = build_prompt(request.query, hits)
         
-        response = call_gemini(
+        response = await acall_gemini(
             api_key=request.api_key,
             prompt=prompt,
             model=request.model,
-            system_prompt=SYSTEM_PROMPT
+            system_prompt=SYSTEM_PROMPT,
+            use_context_cache=GEMINI_CONTEXT_CACHE
         )
 
-        # Log the response ID for debugging
-        logger.info(f"LangChain response ID: {response.id}")
-        
-        return {"response": response, "retrieved_docs": docs, "run_id": response.id}
+        logger.debug("LangChain response ID: %s", response.id)
+
+        result = {"response": response, "retrieved_docs": docs, "run_id": response.id}
+        llm_cache.set(key, result, embedding=embedding, scope=scope)
+        return result
     
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+@app.post("/query/stream")
+async def handle_query_stream(request: QueryRequest):
+    """
+    Server-sent events variant of /query. Emits a `docs` event with the retrieved
+    documents, `token` events as Gemini generates text, then `done` with the run_id
+    (or `error` if generation fails mid-stream).
+    """
+    try:
+        logger.debug("Received streaming query: %s, k: %d", request.query, request.k)
+        key, scope = query_cache_key(request)
+        cached = llm_cache.get_exact(key)
+        if cached is None:
+            retriever = get_retriever(request.api_key)
+            embedding = await retriever.aembed(request.query)
+            cached = llm_cache.get_semantic(embedding, scope=scope)
+        if cached is not None:
+            cached = replay_cached(cached)
+        else:
+            hits = await retriever.asearch_hits(embedding, k=request.k)
+            if is_low_confidence(hits):
+                cached = {"response": AIMessage(content=CANNED_FALLBACK), "retrieved_docs": [], "run_id": None}
+            else:
+                docs = [doc for _, _, doc in hits]
+                prompt = build_prompt(request.query, hits)
+    except Exception as e:
+        logger.error(f"Error processing query: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+    async def events():
+        if cached is not None:
+            yield sse_event("docs", cached["retrieved_docs"])
+            yield sse_event("token", {"text": cached["response"].content})
+            yield sse_event("done", {"run_id": cached["run_id"]})
+            return
+
+        yield sse_event("docs", docs)
+        response = None
+        try:
+            async for chunk in acall_gemini_stream(
+                api_key=request.api_key,
+                prompt=prompt,
+                model=request.model,
+                system_prompt=SYSTEM_PROMPT,
+                use_context_cache=GEMINI_CONTEXT_CACHE
+            ):
+                response = chunk if response is None else response + chunk
+                if chunk.content:
+                    yield sse_event("token", {"text": chunk.content})
+            if response is None:
+                raise ValueError("Empty response content")
+            # Same checks as /query, so a blocked or empty answer is neither confirmed nor cached
+            check_gemini_response(response)
+        except Exception as e:
+            logger.error(f"Error streaming query response: {str(e)}")
+            yield sse_event("error", {"detail": f"Internal server error: {str(e)}"})
+            return
+
+        logger.debug("LangChain response ID: %s", response.id)
+        llm_cache.set(key, {"response": response, "retrieved_docs": docs, "run_id": response.id}, embedding=embedding, scope=scope)
+        yield sse_event("done", {"run_id": response.id})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "message": "UALR Chatbot API is running"}
+    return {"status": "healthy", "message": "UALR Chatbot API is running", "fallback_stats": fallback_stats}
 
 @app.get("/")
 async def root():
@@ -1,77 +1,330 @@
 # retriever.py
 
+import asyncio
 import pickle
+import weakref
 import numpy as np
 import os
 import logging
 import faiss
-from google import genai
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
 from google.genai import types
 
+from app.clients import get_genai_client
+from app.doc_store import DocStore
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Search-time knobs for approximate indexes built by pipeline.py
+IVF_NPROBE = int(os.environ.get("FAISS_NPROBE", "30"))
+HNSW_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+EMBEDDING_CACHE_SIZE = 1024
+
+def set_faiss_threads(workers=1):
+    # Split the cores between server workers so their OpenMP pools don't oversubscribe the CPU
+    threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    faiss.omp_set_num_threads(threads)
+    logger.info(f"FAISS using {threads} OpenMP threads ({workers} workers)")
+    return threads
+
+@lru_cache(maxsize=None)
+def load_index(index_path):
+    try:
+        try:
+            # Map the file instead of reading it into memory: pages are loaded on demand and
+            # shared between worker processes through the page cache
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            # Not every index type (or faiss build) can be mmapped
+            logger.warning(f"Could not mmap FAISS index, reading it into memory: {str(e)}")
+            index = faiss.read_index(index_path)
+        logger.info(f"FAISS index loaded, dimension: {index.d}, num vectors: {index.ntotal}")
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = min(IVF_NPROBE, ivf.nlist)
+            logger.info(f"IVF index: nlist={ivf.nlist}, nprobe={ivf.nprobe}")
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    except Exception as e:
+        logger.error(f"Failed to load FAISS index: {str(e)}")
+        raise
+
+@lru_cache(maxsize=None)
+def load_metadata(metadata_path):
+    try:
+        if os.path.isdir(metadata_path):
+            # Columnar store written by app.doc_store: memory-mapped, rows decoded on access
+            doc_metadata = DocStore(metadata_path)
+        else:
+            with open(metadata_path, "rb") as f:
+                doc_metadata = pickle.load(f)
+        logger.info(f"Metadata loaded, {len(doc_metadata)} entries")
+        return doc_metadata
+    except Exception as e:
+        logger.error(f"Failed to load metadata: {str(e)}")
+        raise
+
+class _Coalescer(ABC):
+    """
+    Coalesces concurrent requests into one batched call. The first queued item opens
+    a window of max_wait_ms (0 means no wait, so a lone request is not delayed);
+    everything queued by then, or while the previous batch was in flight, is handed
+    to _process in a single call (up to max_batch items) and the results are passed
+    back through per-request futures. The consumer task exits once the queue is
+    empty and is started again by the next request, so idle or discarded batchers
+    hold no task.
+    """
+
+    def __init__(self, max_batch, max_wait_ms):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._loop = None
+        self._queue = None
+        self._task = None
+        _COALESCERS.add(self)
+
+    async def _submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = None
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run(self._queue))
+        return await future
+
+    async def _run(self, queue):
+        while not queue.empty():
+            batch = [queue.get_nowait()]
+            if self.max_wait:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                results = await self._process([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                logger.error(f"Failed to process {type(self).__name__} batch: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def aclose(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @abstractmethod
+    async def _process(self, items):
+        """Handle one batch of queued items, returning one result per item."""
+
+
+# Every live batcher, so the app can stop their consumer tasks at shutdown
+_COALESCERS = weakref.WeakSet()
+
+async def close_batchers():
+    for coalescer in list(_COALESCERS):
+        await coalescer.aclose()
+
+
+class EmbeddingBatcher(_Coalescer):
+    """Batches concurrent query texts into one embed_content call."""
+
+    def __init__(self, client, embedding_dim, max_batch=16, max_wait_ms=0):
+        super().__init__(max_batch, max_wait_ms)
+        self.client = client
+        self.embedding_dim = embedding_dim
+
+    async def embed(self, text):
+        return await self._submit(text)
+
+    async def _process(self, texts):
+        response = await self.client.aio.models.embed_content(
+            model='text-embedding-004',
+            contents=texts,
+            config=types.EmbedContentConfig(output_dimensionality=self.embedding_dim),
+        )
+        logger.debug("Embedded batch of %d queries", len(texts))
+        return [np.array(result.values, dtype='float32').reshape(1, -1) for result in response.embeddings]
+
+
+class SearchBatcher(_Coalescer):
+    """
+    Batches concurrent FAISS searches into one index.search call over the stacked
+    query vectors, which runs as a single matrix product instead of one per request.
+    There is no wait window: each batch is whatever was queued by the time the
+    consumer runs, so a lone query is searched right away.
+    """
+
+    def __init__(self, index, max_batch=32, max_wait_ms=0):
+        super().__init__(max_batch, max_wait_ms)
+        self.index = index
+
+    async def search(self, embedding, k):
+        return await self._submit((embedding, k))
+
+    async def _process(self, queries):
+        k_max = max(k for _, k in queries)
+        # Searched inline like Retriever.search_hits; a thread hop would cost more than the search
+        D, I = self.index.search(np.vstack([e for e, _ in queries]), k_max)
+        logger.debug("Searched batch of %d queries", len(queries))
+        return [(D[j:j + 1, :k], I[j:j + 1, :k]) for j, (_, k) in enumerate(queries)]
+
+
+@lru_cache(maxsize=None)
+def get_search_batcher(index_path):
+    # One batcher per index for the whole process, so searches from every api_key share calls
+    return SearchBatcher(load_index(index_path))
+
+
 class Retriever:
-    def __init__(self, index_path, metadata_path, api_key, embedding_dim=768):
-        logger.info(f"Initializing Retriever with index: {index_path}, metadata: {metadata_path}")
+    def __init__(self, index_path, metadata_path, api_key, embedding_dim=768, batch_embeddings=False,
+                 batch_searches=False):
+        logger.debug("Initializing Retriever with index: %s, metadata: %s", index_path, metadata_path)
         self.embedding_dim = embedding_dim
 
-        # Initialize Gemini client
-        try:
-            self.model = genai.Client(api_key=api_key, http_options=types.HttpOptions(api_version='v1alpha'))
-            logger.info("Google Gemini embedding model initialized.")
-        except Exception as e:
-            logger.error(f"Failed to initialize Gemini model: {str(e)}")
-            raise
+        self.model = get_genai_client(api_key)
+        self.batcher = EmbeddingBatcher(self.model, embedding_dim) if batch_embeddings else None
+        # LRU of query embeddings keyed by normalized text; repeated questions skip the embed call
+        self._emb_cache = OrderedDict()
 
-        # Load FAISS index
-        try:
-            self.index = faiss.read_index(index_path)
-            logger.info(f"FAISS index loaded, dimension: {self.index.d}, num vectors: {self.index.ntotal}")
-        except Exception as e:
-            logger.error(f"Failed to load FAISS index: {str(e)}")
-            raise
+        # FAISS index and metadata are shared by every Retriever; only the embedding client is per api_key
+        self.index = load_index(index_path)
+        self.doc_metadata = load_metadata(metadata_path)
+        self.search_batcher = get_search_batcher(index_path) if batch_searches else None
+
+    def similarity(self, distance):
+        if self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            return float(distance)
+        # text-embedding-004 vectors are unit length, so squared L2 maps directly onto cosine
+        return 1.0 - float(distance) / 2.0
+
+    def query(self, text, k=3):
+        logger.debug("Querying with text: %s, k=%d", text, k)
+        embedding = self.embed(text)
+        return self.search(embedding, k=k)
+
+    def embed(self, text):
+        key = self._embedding_key(text)
+        embedding = self._cached_embedding(key)
+        if embedding is None:
+            embedding = self._embed(text)
+            self._cache_embedding(key, embedding)
+        return embedding
 
-        # Load metadata
+    async def aembed(self, text):
+        # Async variant of embed for request handlers, so the event loop is not blocked on the HTTP call
+        key = self._embedding_key(text)
+        embedding = self._cached_embedding(key)
+        if embedding is None:
+            embedding = await self._aembed(text)
+            self._cache_embedding(key, embedding)
+        return embedding
+
+    def _embedding_key(self, text):
+        return " ".join(text.lower().split())
+
+    def _cached_embedding(self, key):
+        embedding = self._emb_cache.get(key)
+        if embedding is not None:
+            self._emb_cache.move_to_end(key)
+            logger.debug("Query embedding cache hit")
+        return embedding
+
+    def _cache_embedding(self, key, embedding):
+        self._emb_cache[key] = embedding
+        if len(self._emb_cache) > EMBEDDING_CACHE_SIZE:
+            self._emb_cache.popitem(last=False)
+
+    def _embed(self, text):
         try:
-            with open(metadata_path, "rb") as f:
-                self.doc_metadata = pickle.load(f)
-            logger.info(f"Metadata loaded, {len(self.doc_metadata)} entries")
+            response = self.model.models.embed_content(
+                model='text-embedding-004',
+                contents=[text],
+                config=types.EmbedContentConfig(output_dimensionality=self.embedding_dim),
+            )
+            embedding = np.array(response.embeddings[0].values, dtype='float32').reshape(1, -1)
+            logger.debug("Generated embedding shape: %s", embedding.shape)
         except Exception as e:
-            logger.error(f"Failed to load metadata: {str(e)}")
+            logger.error(f"Failed to embed query: {str(e)}")
             raise
+        return embedding
 
-    def query(self, text, k=3):
-        logger.info(f"Querying with text: {text}, k={k}")
+    async def _aembed(self, text):
+        if self.batcher is not None:
+            return await self.batcher.embed(text)
         try:
-            response = self.model.models.embed_content(
+            response = await self.model.aio.models.embed_content(
                 model='text-embedding-004',
                 contents=[text],
                 config=types.EmbedContentConfig(output_dimensionality=self.embedding_dim),
             )
             embedding = np.array(response.embeddings[0].values, dtype='float32').reshape(1, -1)
-            logger.info(f"Generated embedding shape: {embedding.shape}")
+            logger.debug("Generated embedding shape: %s", embedding.shape)
         except Exception as e:
             logger.error(f"Failed to embed query: {str(e)}")
             raise
+        return embedding
 
+    def search(self, embedding, k=3):
+        return [doc for _, _, doc in self.search_hits(embedding, k=k)]
+
+    def search_hits(self, embedding, k=3):
+        # Same as search, but returns (row id, cosine similarity, doc) tuples
+        embedding = self._prepare_query(embedding)
         try:
             D, I = self.index.search(embedding, k)
-            logger.info(f"Search results: distances={D[0]}, indices={I[0]}")
         except Exception as e:
             logger.error(f"FAISS search failed: {str(e)}")
             raise
+        return self._collect_hits(D, I)
+
+    async def asearch_hits(self, embedding, k=3):
+        # Async variant of search_hits; concurrent searches share one index.search call when batching
+        embedding = self._prepare_query(embedding)
+        try:
+            if self.search_batcher is not None:
+                D, I = await self.search_batcher.search(embedding, k)
+            else:
+                D, I = self.index.search(embedding, k)
+        except Exception as e:
+            logger.error(f"FAISS search failed: {str(e)}")
+            raise
+        return self._collect_hits(D, I)
+
+    def _prepare_query(self, embedding):
+        if self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            # Inner-product indexes hold unit vectors; normalize a copy so scores are cosine similarities
+            embedding = np.array(embedding, dtype='float32')
+            faiss.normalize_L2(embedding)
+        return embedding
+
+    def _collect_hits(self, D, I):
+        if logger.isEnabledFor(logging.DEBUG):
+            # numpy array formatting is costly, so only do it when debug output is consumed
+            logger.debug("Search results: distances=%s, indices=%s", D[0], I[0])
 
         results = []
-        for i in I[0]:
+        for distance, i in zip(D[0], I[0]):
             if 0 <= i < len(self.doc_metadata):
                 doc = self.doc_metadata[i]
                 if "content" in doc:
-                    results.append(doc)
+                    results.append((int(i), self.similarity(distance), doc))
                 else:
                     logger.warning(f"Metadata entry {i} missing 'content' field: {doc}")
             else:
                 logger.warning(f"Invalid index {i} for metadata (length: {len(self.doc_metadata)})")
 
-        logger.info(f"Returning {len(results)} documents")
+        logger.debug("Returning %d documents", len(results))
         return results
@@ -1,5 +1,5 @@
+import asyncio
 import os
-import pickle
 import numpy as np
 import faiss
 import pandas as pd
@@ -7,22 +7,35 @@ from tqdm import tqdm
 from google import genai
 from google.genai import types
 
+from app.doc_store import write_doc_store
+
 # ---- CONFIG ----
 DATA_DIR = "./data"
 INDEX_PATH = "./faiss_index.faiss"
-METADATA_PATH = "./doc_metadata.pkl"
+METADATA_PATH = "./doc_metadata"  # columnar store read by app.doc_store.DocStore
 EMBEDDING_DIM = 768  # use 768 as per your retriever
 CHUNK_SIZE = 500     # chars per chunk (tune as needed)
 CHUNK_OVERLAP = 100  # chars overlap for continuity
 API_KEY = os.environ.get("GEMINI_API_KEY")  # or set directly
+# "sq8": 8-bit scalar-quantized flat index (4x smaller than fp32, same exhaustive search)
+# "hnsw": HNSW graph over full fp32 vectors (sub-linear search, best recall)
+# "ivf": inverted file over fp32 vectors (sub-linear search, probes nprobe of nlist clusters)
+# "ivfpq": inverted file with product-quantized codes (PQ_M bytes per vector; needs ~10k chunks to train well)
+# "flat": exact fp32 search
+INDEX_TYPE = os.environ.get("INDEX_TYPE", "sq8")
+HNSW_M = 32
+IVF_NLIST = None     # None -> about sqrt(number of chunks)
+PQ_M = 96            # sub-quantizers; must divide EMBEDDING_DIM
+PQ_NBITS = 8
+EMBED_CONCURRENCY = 8  # embed_content requests in flight at once
 
 def chunk_text(text, chunk_size=500, overlap=100):
-    """Yields chunks of text with optional overlap."""
+    """Yields (start, end) offsets of chunks of text with optional overlap."""
     start = 0
     n = len(text)
     while start < n:
         end = min(start + chunk_size, n)
-        yield text[start:end]
+        yield start, end
         start += chunk_size - overlap
 
 def read_txt(path):
@@ -33,22 +46,87 @@ def read_xlsx(path):
     dfs = pd.read_excel(path, sheet_name=None)
     chunks = []
     for sheet, df in dfs.items():
-        for _, row in df.iterrows():
-            line = " | ".join(str(cell) for cell in row if not pd.isna(cell))
-            if line.strip():
-                chunks.extend(chunk_text(line))
+        # Build every row's " | "-joined line column by column instead of iterating rows;
+        # empty cells are skipped, as before
+        cells = df.astype(str).where(df.notna(), "")
+        lines = pd.Series("", index=df.index)
+        for col in cells.columns:
+            cell = cells[col]
+            sep = np.where((lines != "") & (cell != ""), " | ", "")
+            lines = lines + sep + cell
+        for line in lines[lines.str.strip() != ""]:
+            chunks.extend(line[start:end] for start, end in chunk_text(line))
     return chunks
 
-def embed_batch(texts, client):
+async def embed_batch(texts, client, out):
     # batching is important for memory
-    resp = client.models.embed_content(
+    resp = await client.aio.models.embed_content(
         model="text-embedding-004",
         contents=list(texts),
         config=types.EmbedContentConfig(output_dimensionality=EMBEDDING_DIM),
     )
-    # returns a response with .embeddings list
-    arr = [np.array(e.values, dtype="float32") for e in resp.embeddings]
-    return arr
+    # returns a response with .embeddings list; write it straight into the caller's (n, dim) slice
+    out[:] = [e.values for e in resp.embeddings]
+    return out
+
+async def embed_batches(texts, client, batch_size=32, concurrency=EMBED_CONCURRENCY):
+    """
+    Embeds texts in concurrent batches into one preallocated (n, dim) array. Returns the
+    array and a mask of the rows that were embedded (False for rows of failed batches).
+    """
+    out = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    embedded = np.ones(len(texts), dtype=bool)
+    starts = range(0, len(texts), batch_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = tqdm(total=len(starts), desc="Embedding")
+
+    async def run(start):
+        end = start + batch_size
+        async with semaphore:
+            try:
+                await embed_batch(texts[start:end], client, out[start:end])
+            except Exception as e:
+                print(f"Embedding batch {start} failed: {e}")
+                embedded[start:end] = False
+            finally:
+                progress.update(1)
+
+    try:
+        await asyncio.gather(*(run(start) for start in starts))
+    finally:
+        progress.close()
+    return out, embedded
+
+def drop_failed_rows(emb_arr, metadata, embedded):
+    # Drop the chunks of failed batches so index ids still line up with metadata rows
+    if embedded.all():
+        return emb_arr, metadata
+    return emb_arr[embedded], [meta for meta, ok in zip(metadata, embedded) if ok]
+
+def build_index(emb_arr, index_type=INDEX_TYPE, nlist=IVF_NLIST):
+    # Cosine similarity: unit-normalize and search by inner product (Retriever normalizes queries to match)
+    faiss.normalize_L2(emb_arr)
+    n, d = emb_arr.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf":
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivfpq":
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"Unknown INDEX_TYPE: {index_type}")
+    if not index.is_trained:
+        index.train(emb_arr)
+    index.add(emb_arr)
+    return index
 
 def main():
     assert API_KEY, "Set GOOGLE_API_KEY env var (or fill API_KEY directly)."
@@ -61,7 +139,8 @@ def main():
         fpath = os.path.join(DATA_DIR, fname)
         if fname.endswith(".txt"):
             text = read_txt(fpath)
-            for chunk in chunk_text(text, CHUNK_SIZE, CHUNK_OVERLAP):
+            for start, end in chunk_text(text, CHUNK_SIZE, CHUNK_OVERLAP):
+                chunk = text[start:end]
                 all_chunks.append(chunk)
                 all_metadata.append({
                     "source_file": fname,
@@ -79,26 +158,16 @@ def main():
 
     # Memory-saving batching for embeddings
     BATCH_SIZE = 32
-    embeddings = []
-    for i in tqdm(range(0, len(all_chunks), BATCH_SIZE), desc="Embedding"):
-        batch = all_chunks[i:i+BATCH_SIZE]
-        try:
-            batch_emb = embed_batch(batch, client)
-        except Exception as e:
-            print(f"Embedding batch {i} failed: {e}")
-            continue
-        embeddings.extend(batch_emb)
+    emb_arr, embedded = asyncio.run(embed_batches(all_chunks, client, BATCH_SIZE))
+    emb_arr, all_metadata = drop_failed_rows(emb_arr, all_metadata, embedded)
 
     # Build FAISS index
-    emb_arr = np.stack(embeddings)
-    index = faiss.IndexFlatL2(EMBEDDING_DIM)
-    index.add(emb_arr)
+    index = build_index(emb_arr)
     faiss.write_index(index, INDEX_PATH)
-    print(f"Saved FAISS index to {INDEX_PATH}")
+    print(f"Saved {INDEX_TYPE} FAISS index to {INDEX_PATH}")
 
     # Save metadata (for retriever)
-    with open(METADATA_PATH, "wb") as f:
-        pickle.dump(all_metadata, f)
+    write_doc_store(all_metadata, METADATA_PATH)
     print(f"Saved metadata ({len(all_metadata)} entries) to {METADATA_PATH}")
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+import pickle
+
+import pytest
+
+from app.doc_store import DocStore, write_doc_store
+from app.retriever import load_metadata
+
+DOCS = [
+    {"source_file": "a.txt", "content": "first chunk"},
+    {"source_file": "b.xlsx", "content": "Café | 3.5 | ✓"},
+    {"source_file": "c.txt"},
+    {"source_file": "d.txt", "content": ""},
+]
+
+
+def test_round_trip(tmp_path):
+    write_doc_store(DOCS, tmp_path / "store")
+    store = DocStore(tmp_path / "store")
+    assert len(store) == len(DOCS)
+    assert list(store) == DOCS
+
+
+def test_missing_fields_are_not_filled_in(tmp_path):
+    write_doc_store(DOCS, tmp_path / "store")
+    store = DocStore(tmp_path / "store")
+    assert "content" not in store[2]
+    assert store[3]["content"] == ""
+
+
+def test_indexing(tmp_path):
+    write_doc_store(DOCS, tmp_path / "store")
+    store = DocStore(tmp_path / "store")
+    assert store[-1] == DOCS[-1]
+    assert store[1:3] == DOCS[1:3]
+    with pytest.raises(IndexError):
+        store[len(DOCS)]
+
+
+def test_empty_store(tmp_path):
+    write_doc_store([], tmp_path / "store")
+    assert len(DocStore(tmp_path / "store")) == 0
+
+
+def test_load_metadata_reads_store_and_pickle(tmp_path):
+    write_doc_store(DOCS, tmp_path / "store")
+    with open(tmp_path / "docs.pkl", "wb") as f:
+        pickle.dump(DOCS, f)
+    assert list(load_metadata(str(tmp_path / "store"))) == DOCS
+    assert load_metadata(str(tmp_path / "docs.pkl")) == DOCS
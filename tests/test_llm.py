@@ -0,0 +1,71 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import app.llm as llm
+
+
+class FakeCaches:
+    def __init__(self, fail=False):
+        self.created = []
+        self.updated = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def create(self, model, config):
+        time.sleep(0.05)
+        if self.fail:
+            raise ValueError("cached content is too small")
+        with self._lock:
+            self.created.append(model)
+            return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    def update(self, name, config):
+        self.updated.append(name)
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    fake = FakeCaches()
+    monkeypatch.setattr(llm, "get_genai_client", lambda api_key: SimpleNamespace(caches=fake))
+    monkeypatch.setattr(llm, "_CONTEXT_CACHES", llm.TTLCache(maxsize=4, ttl=llm.CONTEXT_CACHE_TTL))
+    return fake
+
+
+def test_concurrent_first_requests_create_one_cache(caches):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        names = list(pool.map(lambda _: llm.get_context_cache("key", "gemini-2.0-flash", "system"), range(8)))
+    assert names == ["cachedContents/1"] * 8
+    assert caches.created == ["gemini-2.0-flash"]
+
+
+def test_cache_is_refreshed_near_expiry(caches, monkeypatch):
+    name = llm.get_context_cache("key", "gemini-2.0-flash", "system")
+    now = time.time()
+    monkeypatch.setattr(llm.time, "time", lambda: now + llm.CONTEXT_CACHE_TTL - llm.CONTEXT_CACHE_REFRESH_MARGIN + 1)
+    assert llm.get_context_cache("key", "gemini-2.0-flash", "system") == name
+    assert caches.updated == [name]
+    assert len(caches.created) == 1
+
+
+def test_failed_create_is_not_retried_until_ttl(caches):
+    caches.fail = True
+    assert llm.get_context_cache("key", "gemini-2.0-flash", "system") is None
+    caches.fail = False
+    assert llm.get_context_cache("key", "gemini-2.0-flash", "system") is None
+    assert caches.created == []
+
+
+def test_unsupported_models_skip_caching(caches):
+    assert llm.get_context_cache("key", "gemini-1.0-pro", "system") is None
+    assert llm.get_context_cache("key", "gemini-2.0-flash", "") is None
+    assert caches.created == []
+
+
+def test_entries_are_bounded(caches):
+    for i in range(10):
+        llm.get_context_cache(f"key{i}", "gemini-2.0-flash", "system")
+    assert len(llm._CONTEXT_CACHES) == 4
@@ -0,0 +1,65 @@
+import time
+
+import numpy as np
+
+from app.llm_cache import LLMCache, cache_key
+
+DIM = 8
+
+
+def vector(seed, noise=0.0):
+    rng = np.random.default_rng(seed)
+    v = rng.random(DIM).astype("float32")
+    if noise:
+        v += noise * np.random.default_rng(seed + 1000).random(DIM).astype("float32")
+    return v
+
+
+def test_cache_key_depends_on_every_part():
+    key = cache_key("m", "sys", "q")
+    assert key == cache_key("m", "sys", "q")
+    assert key != cache_key("m2", "sys", "q")
+    assert key != cache_key("m", "sys2", "q")
+    assert key != cache_key("m", "sys", "q2")
+
+
+def test_exact_hit():
+    cache = LLMCache(embedding_dim=DIM)
+    cache.set("k", "value")
+    assert cache.get_exact("k") == "value"
+    assert cache.get_exact("other") is None
+
+
+def test_semantic_hit_within_scope():
+    cache = LLMCache(embedding_dim=DIM, similarity_threshold=0.95)
+    cache.set("k", "value", embedding=vector(1), scope=("m", 3))
+    assert cache.get_semantic(vector(1, noise=0.01), scope=("m", 3)) == "value"
+    assert cache.get_semantic(vector(1, noise=0.01), scope=("m", 5)) is None
+    assert cache.get_semantic(vector(2), scope=("m", 3)) is None
+
+
+def test_closer_entry_from_another_scope_does_not_hide_a_match():
+    cache = LLMCache(embedding_dim=DIM, similarity_threshold=0.95)
+    cache.set("k5", "k=5 answer", embedding=vector(1, noise=0.02), scope=("m", 5))
+    cache.set("k3", "k=3 answer", embedding=vector(1), scope=("m", 3))
+    assert cache.get_semantic(vector(1), scope=("m", 5)) == "k=5 answer"
+    assert cache.get_semantic(vector(1), scope=("m", 3)) == "k=3 answer"
+
+
+def test_expired_entry_does_not_hide_a_live_match():
+    cache = LLMCache(embedding_dim=DIM, ttl=0.05, similarity_threshold=0.95)
+    cache.set("old", "old answer", embedding=vector(1), scope=("m", 3))
+    time.sleep(0.1)
+    cache.set("new", "new answer", embedding=vector(1, noise=0.02), scope=("m", 3))
+    assert cache.get_exact("old") is None
+    assert cache.get_semantic(vector(1), scope=("m", 3)) == "new answer"
+
+
+def test_expired_entries_are_compacted_out_of_the_index():
+    cache = LLMCache(embedding_dim=DIM, maxsize=2, ttl=0.05)
+    for i in range(4):
+        cache.set(f"k{i}", i, embedding=vector(i))
+    time.sleep(0.1)
+    cache.set("live", "live", embedding=vector(10))
+    assert cache._index.ntotal == 1
+    assert cache.get_semantic(vector(10)) == "live"
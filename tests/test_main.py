@@ -0,0 +1,368 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+import app.main as main
+from app.llm_cache import LLMCache
+
+
+class FakeRetriever:
+    def __init__(self, score=0.9):
+        self.score = score
+        self.embeds = 0
+
+    async def aembed(self, text):
+        self.embeds += 1
+        # Same vector for questions that differ only in case/punctuation, so they hit semantically
+        words = "".join(c for c in text.lower() if c.isalnum() or c == " ").split()
+        rng = np.random.default_rng(abs(hash(" ".join(words))) % 2 ** 32)
+        return rng.random((1, 768)).astype("float32")
+
+    async def asearch_hits(self, embedding, k=3):
+        return [(i, self.score, {"content": f"doc {i}", "source_file": "a.txt"}) for i in range(k)]
+
+
+class FakeGemini:
+    def __init__(self):
+        self.prompts = []
+
+    async def __call__(self, api_key, prompt, model, system_prompt, use_context_cache=False):
+        self.prompts.append(prompt)
+        return AIMessage(content=f"answer {len(self.prompts)}", id=f"run-{len(self.prompts)}")
+
+
+@pytest.fixture
+def retriever(monkeypatch):
+    fake = FakeRetriever()
+    monkeypatch.setattr(main, "get_retriever", lambda api_key: fake)
+    monkeypatch.setattr(main, "llm_cache", LLMCache())
+    return fake
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    fake = FakeGemini()
+    monkeypatch.setattr(main, "acall_gemini", fake)
+    return fake
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_FILE", str(tmp_path / "feedback_log.jsonl"))
+    with TestClient(main.app) as client:
+        yield client
+
+
+def query(client, text="Where is the library?", api_key="KEY", k=3):
+    response = client.post("/query", json={"query": text, "api_key": api_key, "k": k})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_query_miss_calls_gemini(client, retriever, gemini):
+    body = query(client)
+    assert body["response"]["content"] == "answer 1"
+    assert body["run_id"] == "run-1"
+    assert [doc["content"] for doc in body["retrieved_docs"]] == ["doc 0", "doc 1", "doc 2"]
+    assert len(gemini.prompts) == 1
+
+
+def test_exact_hit_does_not_replay_run_id(client, retriever, gemini):
+    query(client)
+    body = query(client)
+    assert body["response"]["content"] == "answer 1"
+    assert body["run_id"] is None
+    assert len(gemini.prompts) == 1
+    assert retriever.embeds == 1
+
+
+def test_semantic_hit_does_not_replay_run_id(client, retriever, gemini):
+    query(client, "Where is the library?")
+    body = query(client, "where is the library")
+    assert body["response"]["content"] == "answer 1"
+    assert body["run_id"] is None
+    assert len(gemini.prompts) == 1
+
+
+def test_cache_is_not_shared_across_api_keys(client, retriever, gemini):
+    query(client, api_key="KEY")
+    body = query(client, api_key="OTHER")
+    assert body["response"]["content"] == "answer 2"
+    assert body["run_id"] == "run-2"
+
+
+def test_cache_is_scoped_by_k(client, retriever, gemini):
+    query(client, k=3)
+    body = query(client, k=5)
+    assert body["run_id"] == "run-2"
+    assert len(body["retrieved_docs"]) == 5
+
+
+class FakeGeminiStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = 0
+
+    async def __call__(self, api_key, prompt, model, system_prompt, use_context_cache=False):
+        self.calls += 1
+        for chunk in self.chunks:
+            yield chunk
+
+
+def stream_events(client, text="Where is the library?", api_key="KEY"):
+    response = client.post("/query/stream", json={"query": text, "api_key": api_key})
+    assert response.status_code == 200
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_stream_emits_docs_tokens_and_done_then_caches(client, retriever, gemini, monkeypatch):
+    stream = FakeGeminiStream([
+        AIMessageChunk(content="Hel", id="run-9"),
+        AIMessageChunk(content="lo", response_metadata={"finish_reason": "STOP"}),
+    ])
+    monkeypatch.setattr(main, "acall_gemini_stream", stream)
+    events = stream_events(client)
+    assert [event for event, _ in events] == ["docs", "token", "token", "done"]
+    assert events[-1][1] == {"run_id": "run-9"}
+
+    body = query(client)
+    assert body["response"]["content"] == "Hello"
+    assert body["run_id"] is None
+    assert gemini.prompts == []
+
+
+def test_stream_rejects_blocked_response_without_caching(client, retriever, gemini, monkeypatch):
+    stream = FakeGeminiStream([
+        AIMessageChunk(content="Partial", id="run-9"),
+        AIMessageChunk(content="", response_metadata={"finish_reason": "SAFETY"}),
+    ])
+    monkeypatch.setattr(main, "acall_gemini_stream", stream)
+    events = stream_events(client)
+    assert events[-1][0] == "error"
+    assert "done" not in [event for event, _ in events]
+
+    assert query(client)["run_id"] == "run-1"
+    assert len(gemini.prompts) == 1
+
+
+def test_low_confidence_returns_canned_fallback(client, retriever, gemini):
+    retriever.score = main.FALLBACK_SCORE_THRESHOLD - 0.01
+    before = dict(main.fallback_stats)
+    body = query(client)
+    assert body["response"]["content"] == main.CANNED_FALLBACK
+    assert body["retrieved_docs"] == []
+    assert body["run_id"] is None
+    assert gemini.prompts == []
+    stats = client.get("/health").json()["fallback_stats"]
+    assert stats["fallbacks"] == before["fallbacks"] + 1
+    assert stats["queries"] == before["queries"] + 1
+
+
+def test_stream_low_confidence_returns_canned_fallback(client, retriever, gemini):
+    retriever.score = main.FALLBACK_SCORE_THRESHOLD - 0.01
+    events = stream_events(client)
+    assert events == [("docs", []), ("token", {"text": main.CANNED_FALLBACK}), ("done", {"run_id": None})]
+
+
+def test_threshold_score_is_answered(client, retriever, gemini):
+    retriever.score = main.FALLBACK_SCORE_THRESHOLD
+    assert query(client)["run_id"] == "run-1"
+
+
+FEEDBACK = {"timestamp": "2025-01-01T00:00:00", "feedback_type": "thumbs_up"}
+
+
+@pytest.fixture
+def feedback_file(tmp_path, monkeypatch):
+    path = tmp_path / "feedback_log.jsonl"
+    monkeypatch.setattr(main, "FEEDBACK_FILE", str(path))
+    return path
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_feedback_is_written_by_shutdown(feedback_file):
+    with TestClient(main.app) as client:
+        for i in range(3):
+            response = client.post("/feedback", json={**FEEDBACK, "query": f"q{i}"})
+            assert response.status_code == 200
+            assert response.json() == {"status": "success", "message": "Feedback received"}
+    lines = read_lines(feedback_file)
+    assert [line["query"] for line in lines] == ["q0", "q1", "q2"]
+    assert lines[0]["timestamp"] == "2025-01-01T00:00:00"
+
+
+def test_feedback_writer_flushes_after_line_limit(feedback_file, monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_FLUSH_LINES", 5)
+
+    async def run():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(main.feedback_writer(queue, open(feedback_file, "ab", buffering=1 << 16)))
+        for i in range(4):
+            queue.put_nowait(b'{"i": %d}\n' % i)
+        await queue.join()
+        before_limit = feedback_file.stat().st_size
+        queue.put_nowait(b'{"i": 4}\n')
+        await queue.join()
+        after_limit = feedback_file.stat().st_size
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return before_limit, after_limit
+
+    before_limit, after_limit = asyncio.run(run())
+    assert before_limit == 0
+    assert after_limit > 0
+    assert len(read_lines(feedback_file)) == 5
+
+
+def test_feedback_writer_flushes_after_interval(feedback_file, monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_FLUSH_INTERVAL", 0.05)
+
+    async def run():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(main.feedback_writer(queue, open(feedback_file, "ab", buffering=1 << 16)))
+        queue.put_nowait(b'{"i": 0}\n')
+        await queue.join()
+        await asyncio.sleep(0.2)
+        size = feedback_file.stat().st_size
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return size
+
+    assert asyncio.run(run()) > 0
+
+
+def test_feedback_returns_500_when_log_cannot_be_opened(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_FILE", str(tmp_path / "missing" / "feedback_log.jsonl"))
+    with TestClient(main.app) as client:
+        response = client.post("/feedback", json=FEEDBACK)
+    # Leaving the block runs shutdown, which must not wait on the dead writer
+    assert response.status_code == 500
+
+
+def test_feedback_returns_500_when_writer_died(feedback_file, monkeypatch):
+    async def failing_writer(queue, f):
+        f.close()
+        raise OSError("disk full")
+
+    monkeypatch.setattr(main, "feedback_writer", failing_writer)
+    with TestClient(main.app) as client:
+        response = client.post("/feedback", json=FEEDBACK)
+    assert response.status_code == 500
+
+
+def test_feedback_writer_retries_lines_from_a_failed_write(feedback_file, monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_FLUSH_INTERVAL", 0.05)
+    write = main.write_feedback_lines
+    failures = [OSError("disk full")]
+
+    def flaky_write(f, lines):
+        if failures:
+            raise failures.pop()
+        write(f, lines)
+
+    monkeypatch.setattr(main, "write_feedback_lines", flaky_write)
+
+    async def run():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(main.feedback_writer(queue, open(feedback_file, "ab", buffering=1 << 16)))
+        queue.put_nowait(b'{"i": 0}\n')
+        await queue.join()
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert read_lines(feedback_file) == [{"i": 0}]
+
+
+def test_feedback_writer_writes_retained_lines_on_close(feedback_file, monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_RETRY_LINES", 2)
+    write = main.write_feedback_lines
+    failures = [OSError("disk full")]
+
+    def flaky_write(f, lines):
+        if failures:
+            raise failures.pop()
+        write(f, lines)
+
+    monkeypatch.setattr(main, "write_feedback_lines", flaky_write)
+
+    async def run():
+        queue = asyncio.Queue()
+        for i in range(3):
+            queue.put_nowait(b'{"i": %d}\n' % i)
+        task = asyncio.create_task(main.feedback_writer(queue, open(feedback_file, "ab", buffering=1 << 16)))
+        await queue.join()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    # The oldest line beyond the retry limit is dropped
+    assert read_lines(feedback_file) == [{"i": 1}, {"i": 2}]
+
+
+def test_feedback_returns_503_when_queue_is_full(feedback_file, monkeypatch):
+    async def stalled_writer(queue, f):
+        try:
+            await asyncio.Event().wait()
+        finally:
+            f.close()
+
+    monkeypatch.setattr(main, "feedback_writer", stalled_writer)
+    monkeypatch.setattr(main, "FEEDBACK_QUEUE_SIZE", 1)
+    monkeypatch.setattr(main, "FEEDBACK_SHUTDOWN_TIMEOUT", 0.05)
+    with TestClient(main.app) as client:
+        assert client.post("/feedback", json=FEEDBACK).status_code == 200
+        assert client.post("/feedback", json=FEEDBACK).status_code == 503
+
+
+def test_feedback_keeps_integers_wider_than_64_bits(feedback_file):
+    with TestClient(main.app) as client:
+        response = client.post("/feedback", json={**FEEDBACK, "retrieved_docs": [{"id": 2 ** 80}]})
+    assert response.status_code == 200
+    assert read_lines(feedback_file)[0]["retrieved_docs"] == [{"id": 2 ** 80}]
+
+
+def test_feedback_validation_error_is_422(feedback_file):
+    with TestClient(main.app) as client:
+        response = client.post("/feedback", json={"feedback_type": "thumbs_up"})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "timestamp"]
+
+
+def test_extract_uuid_from_run_id():
+    uuid = "9f67587f-11c2-4a3f-aef1-1b57a8d5a31d"
+    assert main.extract_uuid_from_run_id(f"run--{uuid}-0") == uuid
+    assert main.extract_uuid_from_run_id(uuid) == uuid
+    assert main.extract_uuid_from_run_id("not-a-uuid") == "not-a-uuid"
+
+
+def test_build_prompt_leads_with_context(monkeypatch):
+    monkeypatch.setattr(main, "_CTX_CACHE", main.LRUCache(maxsize=4))
+    hits = [(7, 0.9, {"content": "first"}), (3, 0.8, {"content": "second"})]
+    prompt = main.build_prompt("Where?", hits)
+    assert prompt == "Context:\nfirst\nsecond\n\nQuestion: Where?\n\nAnswer concisely:"
+    assert main.build_prompt("When?", hits).startswith("Context:\nfirst\nsecond\n\n")
+
+
+def test_get_context_is_reused_by_row_ids(monkeypatch):
+    monkeypatch.setattr(main, "_CTX_CACHE", main.LRUCache(maxsize=4))
+    assert main.get_context([(1, 0.9, {"content": "a"}), (2, 0.8, {"content": "b"})]) == "a\nb"
+    # Same row ids reuse the joined context; a different order is a different context
+    assert main.get_context([(1, 0.5, {"content": "changed"}), (2, 0.5, {"content": "b"})]) == "a\nb"
+    assert main.get_context([(2, 0.9, {"content": "b"}), (1, 0.8, {"content": "a"})]) == "b\na"
@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+
+import pandas as pd
+
+import pipeline
+
+
+def test_read_xlsx_joins_non_empty_cells(tmp_path):
+    path = tmp_path / "courses.xlsx"
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame({
+            "Course": ["CPSC 1370", None, "MATH 1451", None],
+            "Credits": [3, 4, None, None],
+            "Notes": [None, "lab", "Calculus I", None],
+        }).to_excel(writer, sheet_name="Fall", index=False)
+        pd.DataFrame({"Building": ["EIT"]}).to_excel(writer, sheet_name="Rooms", index=False)
+    # Empty cells are skipped without leaving stray separators; empty rows are dropped
+    assert pipeline.read_xlsx(path) == ["CPSC 1370 | 3.0", "4.0 | lab", "MATH 1451 | Calculus I", "EIT"]
+
+
+def test_read_xlsx_chunks_long_rows(tmp_path):
+    path = tmp_path / "long.xlsx"
+    pd.DataFrame({"Text": ["x" * 1000]}).to_excel(path, index=False)
+    assert [len(chunk) for chunk in pipeline.read_xlsx(path)] == [500, 500, 200]
+
+
+def test_chunk_text_yields_overlapping_offsets():
+    text = "abcdefghij"
+    offsets = list(pipeline.chunk_text(text, chunk_size=4, overlap=1))
+    assert offsets == [(0, 4), (3, 7), (6, 10), (9, 10)]
+    assert [text[start:end] for start, end in offsets] == ["abcd", "defg", "ghij", "j"]
+    assert list(pipeline.chunk_text("")) == []
+
+
+class FakeModels:
+    def __init__(self, failing_batch):
+        self.failing_batch = failing_batch
+
+    async def embed_content(self, model, contents, config):
+        if self.failing_batch in contents:
+            raise RuntimeError("quota exceeded")
+        return SimpleNamespace(embeddings=[
+            SimpleNamespace(values=[float(text)] * pipeline.EMBEDDING_DIM) for text in contents
+        ])
+
+
+def test_failed_batches_are_dropped_from_vectors_and_metadata():
+    texts = [str(i) for i in range(10)]
+    client = SimpleNamespace(aio=SimpleNamespace(models=FakeModels(failing_batch="4")))
+    emb_arr, embedded = asyncio.run(pipeline.embed_batches(texts, client, batch_size=3, concurrency=2))
+    # The batch holding "4" is rows 3-5
+    assert embedded.tolist() == [True] * 3 + [False] * 3 + [True] * 4
+
+    metadata = [{"content": text} for text in texts]
+    emb_arr, metadata = pipeline.drop_failed_rows(emb_arr, metadata, embedded)
+    assert [meta["content"] for meta in metadata] == ["0", "1", "2", "6", "7", "8", "9"]
+    assert emb_arr[:, 0].tolist() == [0, 1, 2, 6, 7, 8, 9]
@@ -0,0 +1,141 @@
+import asyncio
+from types import SimpleNamespace
+
+import faiss
+import numpy as np
+import pytest
+
+import app.retriever as retriever
+from app.doc_store import write_doc_store
+
+DIM = 8
+
+
+class FakeModels:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    async def embed_content(self, model, contents, config):
+        self.calls.append(list(contents))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError("quota exceeded")
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=[float(len(text))] * DIM) for text in contents])
+
+
+def fake_client(fail=False):
+    return SimpleNamespace(aio=SimpleNamespace(models=FakeModels(fail)))
+
+
+def test_embedding_batcher_coalesces_concurrent_requests():
+    client = fake_client()
+    batcher = retriever.EmbeddingBatcher(client, DIM, max_batch=4, max_wait_ms=1)
+
+    async def run():
+        results = await asyncio.gather(*(batcher.embed("x" * n) for n in range(1, 7)))
+        # Consumer exits once the queue is drained
+        await asyncio.sleep(0)
+        return results
+
+    results = asyncio.run(run())
+    assert [r[0, 0] for r in results] == [1, 2, 3, 4, 5, 6]
+    assert all(r.shape == (1, DIM) for r in results)
+    assert [len(call) for call in client.aio.models.calls] == [4, 2]
+    assert batcher._task.done()
+
+
+def test_embedding_batcher_fails_every_request_in_a_failed_batch():
+    batcher = retriever.EmbeddingBatcher(fake_client(fail=True), DIM, max_wait_ms=1)
+
+    async def run():
+        return await asyncio.gather(batcher.embed("a"), batcher.embed("b"), return_exceptions=True)
+
+    assert all(isinstance(r, RuntimeError) for r in asyncio.run(run()))
+
+
+def test_embedding_batcher_restarts_after_idle_and_on_a_new_loop():
+    client = fake_client()
+    batcher = retriever.EmbeddingBatcher(client, DIM, max_wait_ms=0)
+
+    async def run():
+        first = await batcher.embed("a")
+        await asyncio.sleep(0)
+        second = await batcher.embed("bb")
+        return first[0, 0], second[0, 0]
+
+    assert asyncio.run(run()) == (1, 2)
+    assert asyncio.run(run()) == (1, 2)
+    assert len(client.aio.models.calls) == 4
+
+
+def test_close_batchers_cancels_in_flight_consumer():
+    batcher = retriever.EmbeddingBatcher(fake_client(), DIM, max_wait_ms=1000)
+
+    async def run():
+        asyncio.create_task(batcher.embed("a"))
+        await asyncio.sleep(0)
+        await retriever.close_batchers()
+        return batcher._task.cancelled()
+
+    assert asyncio.run(run())
+
+
+def test_embedding_batcher_does_not_delay_a_lone_request():
+    client = fake_client()
+    batcher = retriever.EmbeddingBatcher(client, DIM)
+    assert batcher.max_wait == 0
+    result = asyncio.run(batcher.embed("abc"))
+    assert result[0, 0] == 3
+    assert client.aio.models.calls == [["abc"]]
+
+
+def test_embedding_batcher_without_window_batches_queued_requests():
+    client = fake_client()
+    batcher = retriever.EmbeddingBatcher(client, DIM)
+
+    async def run():
+        first = asyncio.create_task(batcher.embed("a"))
+        await asyncio.sleep(0)
+        # Queued while the first embed call is in flight
+        rest = await asyncio.gather(*(batcher.embed("x" * n) for n in range(2, 5)))
+        return [await first, *rest]
+
+    assert [r[0, 0] for r in asyncio.run(run())] == [1, 2, 3, 4]
+    assert client.aio.models.calls == [["a"], ["xx", "xxx", "xxxx"]]
+
+
+@pytest.fixture
+def search_retriever(tmp_path, monkeypatch):
+    vectors = np.random.default_rng(0).random((50, DIM)).astype("float32")
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexFlatIP(DIM)
+    index.add(vectors)
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    write_doc_store([{"content": f"doc {i}"} for i in range(50)], tmp_path / "meta")
+    monkeypatch.setattr(retriever, "get_genai_client", lambda api_key: fake_client())
+    r = retriever.Retriever(str(tmp_path / "index.faiss"), str(tmp_path / "meta"), "key",
+                            embedding_dim=DIM, batch_searches=True)
+    return r, vectors
+
+
+def test_search_batcher_is_shared_per_index(search_retriever, tmp_path):
+    r, _ = search_retriever
+    other = retriever.Retriever(str(tmp_path / "index.faiss"), str(tmp_path / "meta"), "other-key",
+                                embedding_dim=DIM, batch_searches=True)
+    assert other.search_batcher is r.search_batcher
+
+
+def test_batched_search_matches_direct_search(search_retriever):
+    r, vectors = search_retriever
+    queries = [vectors[i:i + 1] for i in range(10)]
+    ks = [1 + i % 4 for i in range(10)]
+
+    async def run():
+        return await asyncio.gather(*(r.asearch_hits(q, k=k) for q, k in zip(queries, ks)))
+
+    batched = asyncio.run(run())
+    direct = [r.search_hits(q, k=k) for q, k in zip(queries, ks)]
+    assert [[hit[0] for hit in hits] for hits in batched] == [[hit[0] for hit in hits] for hits in direct]
+    assert [len(hits) for hits in batched] == ks
+    assert [hits[0][0] for hits in batched] == list(range(10))